@@ -48,7 +48,9 @@ def waypoint_policy(learner_type: str,
                     relaxed: Optional[bool] = False, 
                     angular: Optional[bool] = False, 
                     save_model: Optional[bool] = True,
-                    show_stats: Optional[bool] = True):
+                    show_stats: Optional[bool] = True,
+                    sync_freq: Optional[int] = 10,
+                    plateau_patience: Optional[int] = None):
 
     """ Train a stable/unstable policy to learn a nonlinear dynamical system. """
 
@@ -66,19 +68,22 @@ def waypoint_policy(learner_type: str,
     if normalize_magnitude is not None and not angular:
         waypoint_velocities = normalize_waypoints(waypoint_velocities, normalize_magnitude)
     
-    # Plot the waypoints
-    scatter_waypoints(waypoint_positions, waypoint_velocities, title=f'Subgoal {subgoal} Waypoints')
+    # Maybe plot the waypoints
+    if plot:
+        scatter_waypoints(waypoint_positions, waypoint_velocities, title=f'Subgoal {subgoal} Waypoints')
     
     # Maybe clean the data 
     if clean and not angular:
         waypoint_positions, waypoint_velocities = clean_waypoints(waypoint_positions, waypoint_velocities)
-        scatter_waypoints(waypoint_positions, waypoint_velocities, title=f'Subgoal {subgoal} Cleaned Waypoints')
+        if plot:
+            scatter_waypoints(waypoint_positions, waypoint_velocities, title=f'Subgoal {subgoal} Cleaned Waypoints')
     
     # Maybe augment the data
     if augment_rate is not None and augment_alpha is not None and not angular:   
         logger.info(f'Augmenting data with rate {augment_rate} and alpha {augment_alpha} according to a {augment_distribution} distribution.')
         waypoint_positions, waypoint_velocities = augment_data(waypoint_positions, waypoint_velocities, augment_alpha, augment_rate, augment_distribution)
-        scatter_waypoints(waypoint_positions, waypoint_velocities, title=f'Subgoal {subgoal} Augmented Waypoints')
+        if plot:
+            scatter_waypoints(waypoint_positions, waypoint_velocities, title=f'Subgoal {subgoal} Augmented Waypoints')
 
     if learner_type in ["snds", "nn", "sdsef", "lnet"]: 
         model = NL_DS(network=learner_type, 
@@ -90,7 +95,8 @@ def waypoint_policy(learner_type: str,
                       relaxed=relaxed,
                       fhat_layers=fhat_layers,
                       lpf_layers=lpf_layers)
-        model.fit(waypoint_positions, waypoint_velocities,show_stats=show_stats, n_epochs=n_epochs, lr_initial=1e-4)
+        model.fit(waypoint_positions, waypoint_velocities,show_stats=show_stats, n_epochs=n_epochs, lr_initial=1e-4,
+                  sync_freq=sync_freq, plateau_patience=plateau_patience)
     else:
         raise NotImplementedError(f'Learner type {learner_type} not available!')
 
@@ -116,6 +122,7 @@ def train_policy_for_subgoal(subgoal_data, config, subgoal_index):
         waypoint_positions=waypoint_position,
         waypoint_velocities=waypoint_velocity,
         n_epochs=config["training"]['num_epochs'],
+        plot=config["training"].get('plot', True),
         device=config["training"]['device'],
         subgoal=subgoal_index,
         augment_rate=config["data_processing"]['augment_rate'],
@@ -130,7 +137,9 @@ def train_policy_for_subgoal(subgoal_data, config, subgoal_index):
         relaxed=config["snds"]['relaxed'],
         angular=False,
         save_model=config["training"]['save_model'], 
-        show_stats=config["testing"]['verbose']
+        show_stats=config["testing"]['verbose'],
+        sync_freq=config["training"].get('sync_freq', 10),
+        plateau_patience=config["training"].get('plateau_patience', None)
     )
     logger.info(f"Subgoal {subgoal_index} training complete.")
     return model
@@ -142,48 +151,50 @@ def main(config_path):
     demo = config["training"]['demo']
     data = {}
 
-    # get number of subgoals in the demo
+    # read everything needed from the dataset with a single file handle
     with h5py.File(config["data"]['data_dir'], 'r') as f: 
-        subgoals = f[f"data/demo_{demo}/{config['data']['subgoals_dataset']}"]
-        num_subgoals = len(subgoals)
-    if config["data"]["waypoints_dataset"] is None:
-        logger.info(f'No AWE waypoints provided, using entire trajectory to train the model.')
-        # if no waypoints, train the policy on the entire trajectory 
-        with h5py.File(config["data"]['data_dir'], 'r') as f: 
+        # get number of subgoals in the demo
+        subgoal_indices = f[f"data/demo_{demo}/{config['data']['subgoals_dataset']}"][()]
+        num_subgoals = len(subgoal_indices)
+        joint_pos = np.array(f[f"data/demo_{demo}/obs/robot0_joint_pos"])
+
+        # get the initial state of the environment for playback
+        # NOTE: this is important because the object positions are not the same across demos  
+        initial_state = dict(states=f[f"data/demo_{demo}/states"][0])
+        initial_state["model"] = f[f"data/demo_{demo}"].attrs["model_file"]
+
+        if config["data"]["waypoints_dataset"] is None:
+            logger.info(f'No AWE waypoints provided, using entire trajectory to train the model.')
+            # if no waypoints, train the policy on the entire trajectory 
             abs_actions = f[f"data/demo_{demo}/abs_actions"]
             ee_pos = abs_actions[:, :3]
             ee_vel = f[f"data/demo_{demo}/obs/robot0_eef_vel_lin"][()]
             ee_euler = abs_actions[:, 3:6]
             waypoint_gripper_actions = abs_actions[:, -1]
-            subgoal_indices = f[f"data/demo_{demo}/{config['data']['subgoals_dataset']}"][()]
 
-        for i in range(num_subgoals):
-            if i == 0:
-                start_idx = 0
-            else:
-                start_idx = subgoal_indices[i-1]
-            end_idx = subgoal_indices[i]+1
-            data["subgoal_" + str(i)] = {"waypoint_position": ee_pos[start_idx: end_idx], "waypoint_linear_velocity": ee_vel[start_idx: end_idx], "waypoint_gripper_action": waypoint_gripper_actions[start_idx: end_idx], "waypoint_ee_euler": ee_euler[start_idx: end_idx]}
-    else:
-        for i in range(num_subgoals):
-
-            waypoint_position, _, waypoint_gripper_action, waypoint_ee_euler = load_hdf5_data(
-                dataset=config["data"]['data_dir'],
-                demo_id=demo,
-                waypoints_dataset_name=config["data"]['waypoints_dataset'],
-                subgoals_dataset_name=config["data"]['subgoals_dataset'],
-                subgoal=i
-            )
-
-            waypoint_velocity = np.zeros(waypoint_position.shape)
-            # set the velocity to be the difference between the waypoints
-            for j in range (len(waypoint_position)):
-                if j == len(waypoint_position) - 1:
-                    waypoint_velocity[j] = np.zeros(waypoint_velocity[j].shape)
+            for i in range(num_subgoals):
+                if i == 0:
+                    start_idx = 0
                 else:
-                    waypoint_velocity[j] = waypoint_position[j+1] - waypoint_position[j] 
-            
-            data["subgoal_" + str(i)] = {"waypoint_position": waypoint_position, "waypoint_linear_velocity": waypoint_velocity, "waypoint_gripper_action": waypoint_gripper_action, "waypoint_ee_euler": waypoint_ee_euler}
+                    start_idx = subgoal_indices[i-1]
+                end_idx = subgoal_indices[i]+1
+                data["subgoal_" + str(i)] = {"waypoint_position": ee_pos[start_idx: end_idx], "waypoint_linear_velocity": ee_vel[start_idx: end_idx], "waypoint_gripper_action": waypoint_gripper_actions[start_idx: end_idx], "waypoint_ee_euler": ee_euler[start_idx: end_idx]}
+        else:
+            for i in range(num_subgoals):
+
+                waypoint_position, _, waypoint_gripper_action, waypoint_ee_euler = load_hdf5_data(
+                    dataset=f,
+                    demo_id=demo,
+                    waypoints_dataset_name=config["data"]['waypoints_dataset'],
+                    subgoals_dataset_name=config["data"]['subgoals_dataset'],
+                    subgoal=i
+                )
+
+                waypoint_velocity = np.zeros(waypoint_position.shape)
+                # set the velocity to be the difference between the waypoints, zero at the last one
+                waypoint_velocity[:-1] = np.diff(waypoint_position, axis=0)
+                
+                data["subgoal_" + str(i)] = {"waypoint_position": waypoint_position, "waypoint_linear_velocity": waypoint_velocity, "waypoint_gripper_action": waypoint_gripper_action, "waypoint_ee_euler": waypoint_ee_euler}
 
     logger.info(f'Data loaded from {config["data"]["data_dir"]}.')
 
@@ -192,12 +203,9 @@ def main(config_path):
                 "subgoal_euler": subgoal_data["waypoint_ee_euler"][-1],
                 "subgoal_gripper": subgoal_data["waypoint_gripper_action"][-1]} for subgoal_data in data.values()]
     
-    with h5py.File(config["data"]['data_dir'], 'r') as f: 
-        joint_pos = np.array(f[f"data/demo_{demo}/obs/robot0_joint_pos"])
-        subgoals = f[f"data/demo_{demo}/{config['data']['subgoals_dataset']}"]
-        for i in range(num_subgoals):
-            subgoal_info[i]["index"] = subgoals[i]
-            subgoal_info[i]["joint_pos"] = joint_pos[subgoals[i]]
+    for i in range(num_subgoals):
+        subgoal_info[i]["index"] = subgoal_indices[i]
+        subgoal_info[i]["joint_pos"] = joint_pos[subgoal_indices[i]]
 
     policies = None
 
@@ -211,24 +219,26 @@ def main(config_path):
             waypoint_ee_eulers = np.concatenate([data["subgoal_" + str(i)]["waypoint_ee_euler"] for i in range(num_subgoals)], axis=0)
             data = {"subgoal_0":{"waypoint_position": waypoint_positions, "waypoint_linear_velocity": waypoint_velocities, "waypoint_gripper_action": waypoint_gripper_actions, "waypoint_ee_euler": waypoint_ee_eulers}}
             
-        # Use multiprocessing to train a policy for each subgoal
-        """
-        mp.set_start_method('spawn')  # Must be 'spawn' to avoid issues with CUDA
-        ps = []
-        # Create and start processes
-        for i in range(len(data.keys())):
-            p = mp.Process(
-                target=train_policy_for_subgoal, 
-                args=(data["subgoal_" + str(i)], config, i),
-                name=f"{i}")
-            p.start()
-            ps.append(p)
-
-        # Wait for all processes to finish 
-        for p in ps:
-            p.join(timeout=120)  # Add a timeout to avoid indefinite hanging
-        
-        return"""
+        # Maybe use multiprocessing to train a policy for each subgoal. Each process brings up
+        # its own CUDA context, so this only pays off with many subgoals; by default the
+        # policies are trained sequentially in this process.
+        if config["training"].get("multiprocessing", False):
+            mp.set_start_method('spawn', force=True)  # Must be 'spawn' to avoid issues with CUDA
+            ps = []
+            # Create and start processes
+            for i in range(len(data.keys())):
+                p = mp.Process(
+                    target=train_policy_for_subgoal, 
+                    args=(data["subgoal_" + str(i)], config, i),
+                    name=f"{i}")
+                p.start()
+                ps.append(p)
+
+            # Wait for all processes to finish 
+            for p in ps:
+                p.join()
+            return
+
         policies = []
         for i in range(len(data.keys())):
             model = train_policy_for_subgoal(data["subgoal_" + str(i)], config, i)
@@ -295,15 +305,6 @@ def main(config_path):
         with open(os.path.join(video_path, 'info.txt'), 'w') as f:
             f.write(f"{config}")
 
-        # get the episode number
-        ep = "demo_"+ str(config["training"]['demo'])
-        # get the initial state of the environment
-        # NOTE: this is important because the object positions are not the same across demos  
-        with h5py.File(config["data"]['data_dir'], 'r') as f: 
-            states = f["data/{}/states".format(ep)][()]
-            initial_state = dict(states=states[0])
-            initial_state["model"] = f["data/{}".format(ep)].attrs["model_file"]
-
         playback_dataset(
             dataset_path=config["data"]['data_dir'],
             video_name=video_full_name,
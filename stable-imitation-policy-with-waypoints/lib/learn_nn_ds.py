@@ -8,8 +8,9 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 
+from typing import Tuple
+
 from lib.policy_interface import PlanningPolicyInterface
-from torch.utils.data import DataLoader, TensorDataset
 
 from tqdm.auto import tqdm
 
@@ -65,25 +66,33 @@ class NL_DS(PlanningPolicyInterface):
         logger.info(f'Switching to {self.__device} for computation')
 
         if goal is not None:
-            #self.__goal  = torch.tensor(goal.astype(np.float32), device=self.__device)
-            self.__goal = torch.tensor(goal, dtype=torch.float32, device=self.__device)
+            self.__goal = self._to_tensor(goal)
         else:
             self.__goal = torch.zeros(1, self.__data_dim, device=self.__device)
 
         # network module
         self.__network_type = network
         self.__nn_module: nn.Module = None
+        self.__train_module: nn.Module = None
+        self.__inference_module: nn.Module = None
+        self.__inference_input: torch.Tensor = None
+        self.__inference_input_np: np.ndarray = None
+        self.__inference_device_input: torch.Tensor = None
+        self.__inference_output: torch.Tensor = None
+        self.__inference_output_np: np.ndarray = None
         self._initialize_network()
         self.__nn_module.to(self.__device)
 
         logger.info(f'{network.upper()} network initialized')
-        self.__dataset: DataLoader = None
+        self.__dataset: Tuple[torch.Tensor, torch.Tensor] = None
 
     def fit(self, trajectory: np.ndarray, velocity: np.ndarray, n_epochs: int = 200,
             batch_size: int = 128, show_stats: bool = True, stat_freq: int = 2,
             trajectory_test: np.ndarray = None, velocity_test: np.ndarray = None,
             clip_gradient: bool = True, clip_value_grad: float = 0.5, loss_clip: float = 1e3,
-            stop_threshold: int = 3000, lr_initial: float = 0.001, lr_end_factor: float = 0.01):
+            stop_threshold: int = 3000, lr_initial: float = 0.001, lr_end_factor: float = 0.01,
+            sync_freq: int = 10, ema_decay: float = 0.9, plateau_tol: float = 1e-4,
+            plateau_patience: int = None, amp: bool = True):
         """ Fit a nonlinear model to estimate a dynamical systems.
 
         Args:
@@ -92,57 +101,79 @@ class NL_DS(PlanningPolicyInterface):
             show_ds (bool, optional): Whether to show the final DS or not. Defaults to False.
             title (str, optional): Plot title for the model. Defaults to None.
             show_stats (bool, optional): Show training statistics. Defaults to False.
+            sync_freq (int, optional): Epochs between reading the loss back from the device, which
+                is when the best model, loss clipping and stopping criteria are checked. Defaults to 10.
+            ema_decay (float, optional): Decay of the loss moving average. Defaults to 0.9.
+            plateau_tol (float, optional): Relative change of the loss moving average under which
+                training is considered stalled. Defaults to 1e-4.
+            plateau_patience (int, optional): Number of consecutive stalled syncs before quitting
+                the training loop. Defaults to None, which disables the plateau stop.
+            amp (bool, optional): Use bfloat16 autocast for the forward pass on GPUs that support
+                it. Only applied to nn: snds and sdsef need full precision for their input
+                gradients, and the Bjorck orthonormalization of lnet loses its Lipschitz
+                guarantee in bfloat16. Defaults to True.
         """
 
-        # build the dataset
-        self.__dataset = self._prepare_torch_dataset(trajectory, velocity, batch_size)
+        # build the dataset, kept resident on the device as a single pair of tensors
+        self.__dataset = self._prepare_torch_dataset(trajectory, velocity)
+        trajs, vels = self.__dataset
 
-        if trajectory_test is not None:
-            trajectory_test = torch.from_numpy(trajectory_test.astype(np.float32)).to(self.__device)
-            velocity_test = torch.from_numpy(velocity_test.astype(np.float32)).to(self.__device)
+        # maybe compile the network for the training loop
+        self._compile_network()
 
-            trajectory_test.requires_grad = True
-            velocity_test.requires_grad = True
+        # reuse the resident training tensors when testing on the training data itself
+        if trajectory_test is trajectory and velocity_test is velocity:
+            trajectory_test, velocity_test = trajs, vels
+        elif trajectory_test is not None:
+            trajectory_test = self._to_tensor(trajectory_test)
+            velocity_test = self._to_tensor(velocity_test)
 
-        # optimizer and scheduler
-        optimizer = optim.Adam(self.__nn_module.parameters(), lr=lr_initial)
+        # optimizer and scheduler, fusing the parameter updates into one kernel on GPU
+        on_gpu = str(self.__device).startswith('cuda')
+        optimizer = optim.Adam(self.__nn_module.parameters(), lr=lr_initial, fused=on_gpu)
         scheduler = optim.lr_scheduler.LinearLR(optimizer, start_factor=1.0,
                                                 end_factor=lr_end_factor,
                                                 total_iters=n_epochs)
         criterion = nn.MSELoss()
 
+        # mixed precision forward pass, the optimizer keeps the fp32 weights
+        use_amp = amp and on_gpu and self.__network_type == 'nn' and \
+            torch.cuda.is_bf16_supported()
+
         # start time
         logger.info('Starting the policy training sequence')
         start_time = time.time()
 
         best_train_loss = np.inf
         best_train_epoch = 0
-        best_model = self.__nn_module
-        best_lpf = self.__lpf
+        best_state = None
+        best_lpf_state = None
+
+        # moving average of the loss, kept on device between syncs
+        loss_ema = None
+        best_ema = np.inf
+        plateau_count = 0
 
         # train the model
         self.__nn_module.train()
 
         # training epochs
         for epoch in (par := tqdm(range(n_epochs))):
-            # iterate over minibatches
-            train_losses = []
+            # iterate over minibatches, accumulating the loss on device to avoid host syncs
+            loss_sum = torch.zeros((), device=trajs.device)
+            n_batches = 0
 
-            for trajs_t, vels_t in self.__dataset:
+            for trajs_t, vels_t in self._iterate_batches(batch_size):
 
                 # forward pass
-                optimizer.zero_grad()
-                y_pred = self.__nn_module(trajs_t)
+                optimizer.zero_grad(set_to_none=True)
+                with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=use_amp):
+                    y_pred = self._train_forward(trajs_t)
 
-                # compute loss
-                loss = criterion(y_pred, vels_t)
-                train_losses.append(loss.item())
-
-                if loss > loss_clip or loss == torch.nan:
-                    self._initialize_network()
-                    optimizer = optim.Adam(self.__nn_module.parameters(), lr=lr_initial)
-                    logger.warn('Loss value is too large, reinitializing')
-                    continue
+                    # compute loss
+                    loss = criterion(y_pred, vels_t)
+                loss_sum += loss.detach()
+                n_batches += 1
 
                 # backward pass
                 loss.backward()
@@ -158,14 +189,37 @@ class NL_DS(PlanningPolicyInterface):
                 optimizer.step()
 
             scheduler.step()
-            train_loss = np.mean(train_losses)
+            epoch_loss = loss_sum / n_batches
+            loss_ema = epoch_loss if loss_ema is None else \
+                ema_decay * loss_ema + (1 - ema_decay) * epoch_loss
+
+            # only read the losses back every few epochs
+            if epoch % sync_freq != 0 and epoch != n_epochs - 1:
+                continue
+            train_loss, ema_value = torch.stack([epoch_loss, loss_ema]).tolist()
+
+            # react to diverging or nan/inf loss values
+            if not np.isfinite(train_loss) or train_loss > loss_clip:
+                logger.warning('Loss value is too large or nan/inf, reinitializing')
+                self._initialize_network()
+                self.__nn_module.to(self.__device)
+                self._compile_network()
+                optimizer = optim.Adam(self.__nn_module.parameters(), lr=lr_initial, fused=on_gpu)
+                scheduler = optim.lr_scheduler.LinearLR(optimizer, start_factor=1.0,
+                                                        end_factor=lr_end_factor,
+                                                        total_iters=max(n_epochs - epoch - 1, 1))
+                loss_ema = None
+                best_ema = np.inf
+                plateau_count = 0
+                continue
 
             # save the best model
             if best_train_loss - train_loss > 1e-6:
                 best_train_epoch = epoch
                 best_train_loss = train_loss
-                best_model = copy.deepcopy(self.__nn_module)
-                best_lpf = copy.deepcopy(self.__lpf)
+                best_state = {k: v.detach().clone() for k, v in self.__nn_module.state_dict().items()}
+                best_lpf_state = {k: v.detach().clone() for k, v in self.__lpf.state_dict().items()} \
+                    if self.__lpf is not None else None
 
 
             # tracking the learning process
@@ -177,17 +231,36 @@ class NL_DS(PlanningPolicyInterface):
                 logger.info(f'No progress for a while, quitting the training loop')
                 break
 
-            # react to nan loss values
-            if train_loss == torch.nan or train_loss == torch.inf:
-                logger.info(f'Nan/Inf loss function acquired, reinitializing...')
-                self._initialize_network()
+            # quit early once the loss moving average has plateaued
+            if np.isfinite(best_ema) and abs(ema_value - best_ema) <= plateau_tol * best_ema:
+                plateau_count += 1
+            else:
+                plateau_count = 0
+            best_ema = min(best_ema, ema_value)
+
+            if plateau_patience is not None and plateau_count >= plateau_patience:
+                logger.info(f'Loss has plateaued, quitting the training loop')
+                break
 
 
         total_time = time.time() - start_time
         logger.info(f'Training concluded in {total_time:.4f} seconds')
 
-        self.__nn_module = best_model
-        self.__lpf = best_lpf
+        if best_state is not None:
+            self.__nn_module.load_state_dict(best_state)
+        if best_lpf_state is not None:
+            self.__lpf.load_state_dict(best_lpf_state)
+        self.__inference_module = None
+
+        # release the device copies of the data. The compiled graphs and their CUDA graph pool
+        # (static copies of the training batches) are cached by dynamo, not by the wrapper,
+        # and would otherwise pile up across the policies trained in one process
+        self.__dataset = None
+        if self.__train_module is not self.__nn_module:
+            torch._dynamo.reset()
+        self.__train_module = None
+        if on_gpu:
+            torch.cuda.empty_cache()
 
     def predict(self, trajectory: np.ndarray):
         """ Predict estimated velocities from learning NN_DS.
@@ -199,13 +272,82 @@ class NL_DS(PlanningPolicyInterface):
             np.ndarray: Estimated velocities in shape (sample size, dimension).
         """
 
-        #x = torch.from_numpy(trajectory.astype(np.float32)).to(self.__device)
-        x = torch.tensor(trajectory, dtype=torch.float32, device=self.__device)
-        x.requires_grad = True
+        x = self._to_tensor(trajectory)
 
-        res = self.__nn_module(x)
+        # snds and sdsef need autograd for their input gradients, others skip it entirely
+        with torch.inference_mode(not self._needs_input_grad()):
+            res = self.__nn_module(x)
         return res.detach().cpu().numpy()
 
+    def prepare_inference(self, device: str = None):
+        """ Build a copy of the network for single-point, closed-loop inference.
+
+        In simulation the policy is queried with one point per step, so Python and device
+        transfer overheads outweigh the forward pass itself. The network is copied to the given
+        device in eval mode and, for networks without input gradients in their forward pass
+        (nn and lnet), traced with TorchScript. Persistent input and output buffers are allocated
+        alongside it; on CUDA the host buffers are pinned so that transfers are asynchronous.
+
+        Args:
+            device (str, optional): Device to run inference on. Defaults to CPU for nn and lnet,
+                and to the training device for snds and sdsef, whose goal tensors are plain
+                attributes that do not move with the module.
+        """
+
+        if device is None:
+            device = self.__device if self._needs_input_grad() else 'cpu'
+
+        pin = str(device).startswith('cuda')
+        module = copy.deepcopy(self.__nn_module).to(device).eval()
+        input_t = torch.zeros(1, self.__data_dim, pin_memory=pin)
+        output_t = torch.zeros(1, self.__data_dim, pin_memory=pin)
+        device_input_t = input_t.to(device)
+
+        if not self._needs_input_grad():
+            with torch.no_grad():
+                module = torch.jit.trace(module, device_input_t)
+
+        self.__inference_module = module
+        self.__inference_input = input_t
+        self.__inference_input_np = input_t.numpy()
+        self.__inference_device_input = device_input_t
+        self.__inference_output = output_t
+        self.__inference_output_np = output_t.numpy()
+
+    def predict_into(self, out: np.ndarray, position: np.ndarray):
+        """ Predict the velocity of a single point, writing the result into a given array.
+
+        Uses the inference network built by prepare_inference, which is called on first use
+        (on its default device). Avoids tensor allocation on every call.
+
+        Args:
+            out (np.ndarray): Output array of size data_dim, filled with the velocity.
+            position (np.ndarray): A single point of size data_dim.
+
+        Returns:
+            np.ndarray: The output array.
+        """
+
+        if self.__inference_module is None:
+            self.prepare_inference()
+
+        self.__inference_input_np[0] = np.reshape(position, -1)
+        on_host = self.__inference_device_input is self.__inference_input
+        if not on_host:
+            self.__inference_device_input.copy_(self.__inference_input, non_blocking=True)
+
+        with torch.inference_mode(not self._needs_input_grad()):
+            res = self.__inference_module(self.__inference_device_input)
+
+        if on_host:
+            out[:] = res.detach().numpy().reshape(out.shape)
+        else:
+            # copy back into pinned memory and wait for that single transfer
+            self.__inference_output.copy_(res.detach(), non_blocking=True)
+            torch.cuda.current_stream(res.device).synchronize()
+            out[:] = self.__inference_output_np.reshape(out.shape)
+        return out
+
     def lpf(self, x: np.ndarray = np.array([0, 0])):
         """Return the Lyapunov function.
 
@@ -219,12 +361,10 @@ class NL_DS(PlanningPolicyInterface):
         if self.__lpf is None:
             return None
 
-        x = torch.from_numpy(x.astype(np.float32))
-        x.requires_grad = True
-
-        x = x.to(device=self.__device)
+        x = self._to_tensor(x)
         x = x.reshape(1, self.__data_dim)
-        res = self.__lpf.forward(x)
+        with torch.inference_mode():
+            res = self.__lpf.forward(x)
         return res.detach().cpu().numpy()
 
     def load(self, model_name: str, dir: str = '../res'):
@@ -240,6 +380,7 @@ class NL_DS(PlanningPolicyInterface):
         else:
             self.__nn_module = torch.load(os.path.join(dir, f'{self.__network_type}',
                                                    f'{model_name}.pt'))
+        self.__inference_module = None
 
 
     def save(self, model_name: str, dir: str = '../res'):
@@ -279,31 +420,116 @@ class NL_DS(PlanningPolicyInterface):
             raise NotImplementedError(f'Network type {self.__network_type} is not available!')
 
 
-    def _prepare_torch_dataset(self, trajs: np.ndarray, vels: np.ndarray, batch_size: int):
-            """ Convert npy data to tensor dataset.
+    def _compile_network(self):
+        """ Wrap the network with torch.compile for the training loop, if possible.
+
+        The small MLPs trained here are bound by kernel launch overhead, which compilation
+        reduces by fusing ops. Only done on CUDA, and only for 'nn': snds and sdsef
+        differentiate w.r.t. their input inside forward, and torch.compile does not support
+        the resulting double backward, while lnet syncs with the host in GroupSort and feeds a
+        CPU tensor into the Bjorck scaling, which breaks the graph and rules out CUDA graphs.
+        Falls back to eager mode on failure, see also
+        _train_forward for errors raised once the compiled network is first called.
+        """
+
+        self.__train_module = self.__nn_module
+        if not hasattr(torch, 'compile') or not str(self.__device).startswith('cuda') or \
+                self.__network_type != 'nn':
+            return
+
+        try:
+            self.__train_module = torch.compile(self.__nn_module, mode='reduce-overhead',
+                                                dynamic=False)
+        except Exception as e:
+            logger.warning(f'torch.compile failed, training in eager mode: {e}')
+
+
+    def _train_forward(self, x: torch.Tensor):
+        """ Forward pass of the training loop.
 
-            NOTE: Batch size is fixed for small dataset
+        torch.compile is lazy, so compilation errors (e.g. a missing Triton) only surface on
+        the first call of the compiled network. In that case fall back to the eager network
+        for the rest of the training.
+
+        Args:
+            x (torch.Tensor): Input batch.
+
+        Returns:
+            torch.Tensor: Predicted velocities.
+        """
+
+        if self.__train_module is self.__nn_module:
+            return self.__nn_module(x)
+
+        try:
+            return self.__train_module(x)
+        except Exception as e:
+            logger.warning(f'Compiled network failed, training in eager mode: {e}')
+            self.__train_module = self.__nn_module
+            return self.__nn_module(x)
+
+
+    def _iterate_batches(self, batch_size: int):
+        """ Iterate over minibatches of the dataset, reshuffled on device at every call.
+
+        A dataset that fits in a single batch is yielded as is, since shuffling it does not
+        change the loss.
+
+        Args:
+            batch_size (int): Size of the minibatches.
+        """
+
+        trajs, vels = self.__dataset
+        n_samples = trajs.shape[0]
+
+        if n_samples <= batch_size:
+            yield trajs, vels
+            return
+
+        for idx in torch.randperm(n_samples, device=trajs.device).split(batch_size):
+            yield trajs[idx], vels[idx]
+
+
+    def _needs_input_grad(self):
+        """ Whether the network differentiates w.r.t. its input inside forward (snds, sdsef).
+        """
+
+        return self.__network_type in ['snds', 'sdsef']
+
+
+    def _to_tensor(self, arr: np.ndarray):
+        """ Convert a numpy array to a float32 tensor on the computation device.
+
+        The array is cast on the host once (no copy if already contiguous float32) and
+        then moved to the device in a single transfer.
+
+        Args:
+            arr (np.ndarray): Input array.
+
+        Returns:
+            torch.Tensor: The converted tensor.
+        """
+
+        x = torch.from_numpy(np.ascontiguousarray(arr, dtype=np.float32))
+        return x.to(self.__device, non_blocking=True)
+
+
+    def _prepare_torch_dataset(self, trajs: np.ndarray, vels: np.ndarray):
+            """ Convert npy data to device-resident tensors.
+
+            Minibatches are drawn by indexing these tensors with a random permutation in fit,
+            which avoids the per-batch overhead of a DataLoader on small datasets.
 
             Args:
                 trajs (np.ndarray): Demonstrated trajectories.
                 vels (np.ndarray): Demonstrated velocities.
-                batch_size (int): Size of data batches for the loader.
+
+            Returns:
+                Tuple[torch.Tensor, torch.Tensor]: Trajectory and velocity tensors.
             """
 
             # convert npy to tensor
-            #x = torch.from_numpy(trajs.astype(np.float32))
-            #y = torch.from_numpy(vels.astype(np.float32))
-            x = torch.tensor(trajs, dtype=torch.float32, device=self.__device)
-            y = torch.tensor(vels, dtype=torch.float32, device=self.__device)
-
-            #x = x.to(device=self.__device)
-            #y = y.to(device=self.__device)
-
-            x.requires_grad = True
-            y.requires_grad = True
-
-            # generate a dataloader
-            dataset = TensorDataset(x, y)
-            batch_size = batch_size if batch_size < trajs.shape[0] else trajs.shape[0]
-            return DataLoader(dataset, batch_size=batch_size, shuffle=True)
+            x = self._to_tensor(trajs)
+            y = self._to_tensor(vels)
 
+            return x, y
@@ -125,6 +125,11 @@ class Dynamics(nn.Module):
         self.relaxed = relaxed
 
     def forward(self, x):
+        # the Lyapunov gradient is taken w.r.t. the input, so track it here rather than
+        # requiring callers to store their data with requires_grad
+        if not x.requires_grad:
+            x = x.detach().requires_grad_(True)
+
         fx = self.fhat(x)
         Vx = self.V(x)
 
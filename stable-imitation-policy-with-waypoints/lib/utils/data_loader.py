@@ -25,7 +25,7 @@ N_SAMPLES_LASA_HANDWRITING = 1000
 N_DEMONSTRATIONS_LASA_HANDWRITING = 7
 
 def load_hdf5_data(
-        dataset: str = "../data/",
+        dataset: Union[str, h5py.File] = "../data/",
         demo_id = 0,
         waypoints_dataset_name = "AWE_waypoints",
         subgoals_dataset_name = "AWE_subgoals",
@@ -46,7 +46,8 @@ def load_hdf5_data(
                 ...
         - the reconstructed trajectories are obtained by linearly interpolating the end-effector positions of the waypoints (125 actions between each waypoint)
     Args:
-        dataset (str): The path to the hdf5 dataset file.
+        dataset (str or h5py.File): The path to the hdf5 dataset file, or an already open file.
+            An open file is left open, so that several subgoals can be loaded with one handle.
         demo_id (int): The index of the demonstration to load.
         waypoints_dataset_name (str): The name of the dataset containing the waypoints.
         subgoals_dataset_name (str): The name of the dataset containing the subgoals.
@@ -58,7 +59,8 @@ def load_hdf5_data(
         np.array: The gripper actions of the waypoints in the segment.
     """
 
-    f = h5py.File(dataset, 'r')
+    own_file = not isinstance(dataset, h5py.File)
+    f = h5py.File(dataset, 'r') if own_file else dataset
 
     demo_waypoints = f[f'data/demo_{demo_id}/{waypoints_dataset_name}']
     #print("demo_waypoints", demo_waypoints)
@@ -92,7 +94,8 @@ def load_hdf5_data(
         # can get orientation with f[f'data/demo_{demo_id}/obs/robot0_eef_quat'][waypoint]
         # can get gripper action with f[f'data/demo_{demo_id}/abs_action'][waypoint][-1] (the value will be either 1 for open or -1 for close)
 
-    f.close()
+    if own_file:
+        f.close()
     # convert to numpy arrays and return
 
     return np.array(pos_data), np.array(vel_data), np.array(gripper_data), np.array(euler_data)
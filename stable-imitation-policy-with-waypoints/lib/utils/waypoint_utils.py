@@ -63,6 +63,7 @@ def scatter_waypoints(waypoint_position, waypoint_velocity, title, save_path=Non
         fig.savefig(f'plots/waypoints/{title.replace(" ", "-")}.png')
     else:
         fig.savefig(f'{save_path}/{title.replace(" ", "-")}.png')
+    plt.close(fig)
 
 
 def twoD_plots_from_ee_pos(x, y, z, subgoals, title, save_path=None):
@@ -346,49 +347,38 @@ def normalize_waypoints(waypoint_velocity, magnitude):
     # set the last waypoint velocity to zero
     waypoint_velocity[-1] = np.zeros_like(waypoint_velocity[-1])
 
-    for i in range(waypoint_velocity.shape[0]):
-        norm = np.linalg.norm(waypoint_velocity[i])
-
-        if norm > 0:
-            normalized_velocity = (waypoint_velocity[i] / norm) * magnitude
-        else:
-            normalized_velocity = np.zeros_like(waypoint_velocity[i])  # Handle zero vector case
-        waypoint_velocity[i] = normalized_velocity
+    # scale every nonzero velocity to the given magnitude, leaving zero vectors untouched
+    norms = np.linalg.norm(waypoint_velocity, axis=1, keepdims=True)
+    np.divide(waypoint_velocity * magnitude, norms, out=waypoint_velocity, where=norms > 0)
     return waypoint_velocity
 
 def augment_data(waypoint_positions, waypoint_velocities, alpha=0.01, augment_rate=5, distribution='normal'):
     """Augment the data by adding Gaussian noise to the waypoints."""
 
-    new_positions = []
-    new_velocities = []
-
-    for i in range(len(waypoint_positions)-1):
-        # add the original point
-        new_positions.append(waypoint_positions[i])
-        new_velocities.append(waypoint_velocities[i])
-        # for each original point apart from the last one, generate augment_rate new points
-        for _ in range(augment_rate):
-            if distribution == 'normal':
-                noise = np.random.normal(0, alpha, waypoint_positions[i].shape)
-            elif distribution == 'uniform':
-                noise = np.random.uniform(-alpha, alpha, waypoint_positions[i].shape)
-            else:
-                raise ValueError(f"Unknown distribution type: {distribution}")
-            new_position = waypoint_positions[i] + noise
-            new_positions.append(new_position)
-            velocity_norm = np.linalg.norm(waypoint_velocities[i])
-            old_norm = np.linalg.norm(new_position - waypoint_positions[i+1])
-            new_velocities.append(( waypoint_positions[i+1] - new_position )/old_norm * velocity_norm)
-    
-    # add the last point
-    new_positions.append(waypoint_positions[-1])
-    new_velocities.append(waypoint_velocities[-1])
+    # for each original point apart from the last one, generate augment_rate new points
+    positions = waypoint_positions[:-1]
+    velocities = waypoint_velocities[:-1]
+    noise_shape = (positions.shape[0], augment_rate, positions.shape[1])
+    if distribution == 'normal':
+        noise = np.random.normal(0, alpha, noise_shape)
+    elif distribution == 'uniform':
+        noise = np.random.uniform(-alpha, alpha, noise_shape)
+    else:
+        raise ValueError(f"Unknown distribution type: {distribution}")
+    new_positions = positions[:, None, :] + noise
+
+    # new points head to the next waypoint with the speed of the original point
+    directions = waypoint_positions[1:, None, :] - new_positions
+    new_velocities = directions / np.linalg.norm(directions, axis=2, keepdims=True) \
+        * np.linalg.norm(velocities, axis=1)[:, None, None]
 
-    # Convert to numpy arrays
-    augmented_positions = np.array(new_positions)
-    augmented_velocities = np.array(new_velocities)
+    # interleave each original point with its augmented points, then add the last point
+    dim = waypoint_positions.shape[1]
+    augmented_positions = np.concatenate([positions[:, None, :], new_positions], axis=1).reshape(-1, dim)
+    augmented_velocities = np.concatenate([velocities[:, None, :], new_velocities], axis=1).reshape(-1, dim)
+    augmented_positions = np.concatenate([augmented_positions, waypoint_positions[-1:]], axis=0)
+    augmented_velocities = np.concatenate([augmented_velocities, waypoint_velocities[-1:]], axis=0)
 
-    #print(f"augmented_velocities: {augmented_velocities}") 
     return augmented_positions, augmented_velocities
 
 def clean_waypoints(waypoint_positions, waypoint_velocities):
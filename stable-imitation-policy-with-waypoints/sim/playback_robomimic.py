@@ -4,6 +4,8 @@ A collection of functions to playback the simulation with the given policies and
 
 import h5py
 import imageio
+import queue
+import threading
 import numpy as np
 
 import robomimic
@@ -22,6 +24,43 @@ from scipy.spatial.transform import Slerp
 from lib.utils.waypoint_utils import twoD_plots_from_ee_pos
 
 
+# environments built by get_env, keyed by (dataset_path, render_offscreen)
+_ENV_CACHE = {}
+
+
+def get_env(dataset_path, render_offscreen=False):
+    """
+    Create the robosuite environment of a dataset, caching it so that subsequent playbacks
+    of the same dataset skip the observation spec setup and environment construction.
+
+    args:
+        dataset_path (str): path to the hdf5 dataset
+        render_offscreen (bool): whether the environment should support offscreen rendering
+    """
+    key = (dataset_path, render_offscreen)
+    if key in _ENV_CACHE:
+        return _ENV_CACHE[key]
+
+    dummy_spec = dict(
+        obs=dict(
+                low_dim=["robot0_eef_pos"],
+                rgb=[],
+            ),
+    )
+    ObsUtils.initialize_obs_utils_with_obs_specs(dummy_spec)
+
+    env_meta = FileUtils.get_env_metadata_from_dataset(dataset_path)
+    env_meta["env_kwargs"]["controller_configs"]["interpolation"] = "linear"
+    env_meta["env_kwargs"]["controller_configs"]["control_delta"] = True # Whether to control the robot using delta or absolute commands (where absolute commands are taken in the world coordinate frame)
+
+    if not EnvUtils.is_robosuite_env(env_meta): 
+        raise ValueError("Playback only supported for robosuite environments.")
+
+    env = EnvUtils.create_env_from_metadata(env_meta=env_meta, render=False, render_offscreen=render_offscreen)
+    _ENV_CACHE[key] = env
+    return env
+
+
 def playback_dataset(
     dataset_path,
     video_name=None,
@@ -63,29 +102,14 @@ def playback_dataset(
     if write_video:
         print("writing video to ", video_name)
 
-    # Create environment
-    dummy_spec = dict(
-        obs=dict(
-                low_dim=["robot0_eef_pos"],
-                rgb=[],
-            ),
-    )
-    ObsUtils.initialize_obs_utils_with_obs_specs(dummy_spec)
-
-    env_meta = FileUtils.get_env_metadata_from_dataset(dataset_path)
-    env_meta["env_kwargs"]["controller_configs"]["interpolation"] = "linear"
-    env_meta["env_kwargs"]["controller_configs"]["control_delta"] = True # Whether to control the robot using delta or absolute commands (where absolute commands are taken in the world coordinate frame)
-
-    env = EnvUtils.create_env_from_metadata(env_meta=env_meta, render=False, render_offscreen=write_video)
+    # Create environment, or reuse the one built by a previous call
+    env = get_env(dataset_path, render_offscreen=write_video)
     print("=======================================================================================")    
     print("ENV:",env)
 
-    if not EnvUtils.is_robosuite_env(env_meta): 
-        raise ValueError("Playback only supported for robosuite environments.")
-
     # Initialize video writer
     if write_video:
-        video_writer = imageio.get_writer(video_name, fps=20)
+        video_writer = AsyncVideoWriter(video_name, fps=20)
 
     slerp = False
     if slerp_steps is not None:
@@ -100,12 +124,19 @@ def playback_dataset(
     if len(policies) == 1:
         # handle the case where there is only one policy
         policies = [policies[0] for _ in range(len(subgoals))]
+
+    # build the per-step inference copies of the networks up front: on CPU for nn and lnet,
+    # on the training device for snds and sdsef (see NL_DS.prepare_inference)
+    for policy in set(policies):
+        policy.prepare_inference()
    
     add_noise = noise_alpha is not None
     if add_noise: 
         proprio_corrupter = create_gaussian_noise_corrupter(mean=0.0, std=noise_alpha)
     subgoal_successes = [0,0,0]
     num_successes = 0
+    # preallocated action of the control loop: [linear (3), angular (3), gripper (1)]
+    action_buf = np.zeros(7)
     for j in range(rollouts):
         logger.info(f"Rollout {j}")
         trajectory = []
@@ -120,14 +151,18 @@ def playback_dataset(
             print(f"Subgoal {i}")
             if success : 
                 print("Task successful")
+            # per-subgoal constants, hoisted out of the control loop
             subgoal_ee_euler = subgoals[i]["subgoal_euler"]
+            subgoal_pos = np.asarray(subgoals[i]["subgoal_pos"])
             # set the threshold for the distance to the subgoal
             # Insight: if grasping, need higher accuracy than if releasing
             threshold = grasp_tresh if subgoals[i]["subgoal_gripper"] == 1 else release_tresh
+            # compare squared distances in the control loop to skip a sqrt per step
+            threshold_sq = threshold ** 2
             first = True
             subgoal_action_num = 0
-            distance = math.dist(subgoals[i]["subgoal_pos"], obs["robot0_eef_pos"])
-            while distance > threshold and action_num < max_horizon:
+            distance_sq = float(np.square(subgoal_pos - obs["robot0_eef_pos"]).sum())
+            while distance_sq > threshold_sq and action_num < max_horizon:
                 # add info to trajectory
                 abs_pos = np.array(obs["robot0_eef_pos"])
                 traj_info = (np.array([action_num, i]))
@@ -146,11 +181,9 @@ def playback_dataset(
                         action = np.concatenate((action_linear, action_angular, action_gripper))
                         obs, _, _, _ = env.step(action) 
                         if pseudo_action_num % video_skip == 0 and write_video:
-                            video_img = []
-                            for cam_name in camera_names:
-                                video_img.append(put_text(env.render(mode="rgb_array", height=512, width=512, camera_name=cam_name), f"Perturbing to {perturb_ee_pos[j]}", font_size=1, thickness=2, position="bottom"))
-                            video_img = np.concatenate(video_img, axis=1)
-                            video_writer.append_data(video_img)
+                            video_img = [env.render(mode="rgb_array", height=512, width=512, camera_name=cam_name) for cam_name in camera_names]
+                            caption = (f"Perturbing to {perturb_ee_pos[j]}", 1, 2, "bottom")
+                            video_writer.append_data(video_img, [caption] * len(video_img))
 
                         pseudo_action_num += 1
                 
@@ -168,12 +201,8 @@ def playback_dataset(
                     key_times = [0, 1]
                     slerp = Slerp(key_times, key_rots)
 
-                current_ee_pos = obs["robot0_eef_pos"]
-                # reshape
-                current_ee_pos = np.array(current_ee_pos).reshape(1,3)
-
                 # Get the linear action
-                action_linear = np.array(policies[i].predict(current_ee_pos))[0]
+                policies[i].predict_into(action_buf[0:3], obs["robot0_eef_pos"])
 
                 if slerp: # use slerp for orientation control
                     fraction = subgoal_action_num/slerp_steps
@@ -189,37 +218,29 @@ def playback_dataset(
                 else:
                     action_angular = subgoal_ee_euler - sim_euler
                 # normalize if norm is too big
-                if np.linalg.norm(action_angular) > 0.25:
-                    action_angular = action_angular / np.linalg.norm(action_angular) * 0.25
+                angular_norm = np.linalg.norm(action_angular)
+                if angular_norm > 0.25:
+                    action_angular = action_angular / angular_norm * 0.25
+                action_buf[3:6] = action_angular
                                 
-                if i == 0 :
-                    action_gripper = np.array ([-1])  # Open the gripper for the first subgoal
-                else:
-                    action_gripper = np.array([1])
-
-                action = np.concatenate((action_linear, action_angular, action_gripper))
-                
-                action = np.array(action, copy=True)
+                # Open the gripper for the first subgoal
+                action_buf[6] = -1 if i == 0 else 1
                 
                 # add entire action to trajectory
-                traj_abs_action = np.concatenate((traj_info, abs_pos, next_euler, action)).tolist()
+                traj_abs_action = np.concatenate((traj_info, abs_pos, next_euler, action_buf)).tolist()
                 traj_abs_action[0] = int(traj_abs_action[0])
                 traj_abs_action[1] = int(traj_abs_action[1])
                 trajectory.append(traj_abs_action)
 
                 # Take the action in the environment
-                obs, _, done, _ = env.step(action)
+                obs, _, done, _ = env.step(action_buf)
 
                 # Save the frames (agentview)
                 if action_num % video_skip == 0 and write_video:
-                    video_img = []
-                    for k, cam_name in enumerate(camera_names):
-                        if k == 0: video_img.append(put_text(env.render(mode="rgb_array", height=512, width=512, camera_name=cam_name), f"Subgoal {i}, Rollout {j}", font_size=0.75, thickness=1, position="bottom"))
-                        if k == 1: video_img.append(put_text(env.render(mode="rgb_array", height=512, width=512, camera_name=cam_name), f"Success: {success}", font_size=0.75, thickness=1, position="bottom"))
-
-                    video_img = np.concatenate(video_img, axis=1)  # Concatenate horizontally
-                    video_img = put_text(video_img, f"ee_euer: {sim_euler}, ee_pos: {obs['robot0_eef_pos']}", font_size=0.25, thickness=1, position="top")
-                    video_writer.append_data(video_img)
+                    video_img = [env.render(mode="rgb_array", height=512, width=512, camera_name=cam_name) for cam_name in camera_names[:2]]
+                    captions = [(f"Subgoal {i}, Rollout {j}", 0.75, 1, "bottom"), (f"Success: {success}", 0.75, 1, "bottom")]
+                    overlay = (f"ee_euer: {sim_euler}, ee_pos: {obs['robot0_eef_pos']}", 0.25, 1, "top")
+                    video_writer.append_data(video_img, captions[:len(video_img)], overlay)
             
                 action_num += 1
         
@@ -229,13 +250,14 @@ def playback_dataset(
                 if action_num % 25 == 0 and verbose:
                     logger.info(f"subgoal_euler: {subgoal_ee_euler}, sim_euler: {sim_euler}")
                     #print("subgoal_quat: ", subgoal_quat, "sim_quat: ", sim_quat)
-                    logger.info(f"Distance to subgoal {i}: {distance}, Action number: {action_num}, Current euler: {sim_euler}, Subgoal euler: {subgoal_ee_euler}")
-                    logger.info(f"Action: {action}")
+                    logger.info(f"Distance to subgoal {i}: {np.sqrt(distance_sq)}, Action number: {action_num}, Current euler: {sim_euler}, Subgoal euler: {subgoal_ee_euler}")
+                    logger.info(f"Action: {action_buf}")
                     logger.info(f"Success: {success}")
                 
                 #update distance
-                distance = math.dist(subgoals[i]["subgoal_pos"], true_ee_pos)
+                distance_sq = float(np.square(subgoal_pos - true_ee_pos).sum())
 
+            distance = np.sqrt(distance_sq)
 
             if distance > threshold and action_num >= max_horizon and reset_on_fail:
                 # Subgoal failed
@@ -245,11 +267,10 @@ def playback_dataset(
                 env.reset_to(initial_state)                
                 desired_joint_positions =  subgoals[i]["joint_pos"]
                 env.env.sim.data.qpos[env.env.robots[0].joint_indexes] = desired_joint_positions
-                video_img = []
-                for cam_name in camera_names:
-                    video_img.append(put_text(env.render(mode="rgb_array", height=512, width=512, camera_name=cam_name), f"Reset env", font_size=1, thickness=2, position="bottom"))
-                video_img = np.concatenate(video_img, axis=1)  # Concatenate horizontally
-                video_writer.append_data(video_img)
+                if write_video:
+                    video_img = [env.render(mode="rgb_array", height=512, width=512, camera_name=cam_name) for cam_name in camera_names]
+                    caption = (f"Reset env", 1, 2, "bottom")
+                    video_writer.append_data(video_img, [caption] * len(video_img))
             else:
                 # Subgoal succeeded
                 subgoal_successes[i] += 1
@@ -260,7 +281,7 @@ def playback_dataset(
             # Activate the gripper
             action_gripper = subgoals[i]["subgoal_gripper"]
             action_gripper_string = "Open" if action_gripper == -1 else "Close"
-            action = np.zeros_like(action)
+            action = np.zeros_like(action_buf)
             action[-1] = action_gripper
             if verbose:
                 logger.info("\n####################################################\n################ Activating gripper ################\n####################################################")
@@ -268,11 +289,9 @@ def playback_dataset(
             while True:
                 obs, _, _, _ = env.step(action)
                 if action_num % video_skip == 0 and write_video:
-                    video_img = []
-                    for cam_name in camera_names:
-                        video_img.append(put_text(env.render(mode="rgb_array", height=512, width=512, camera_name=cam_name), f"Gripper Action: {action_gripper_string}", font_size=1, thickness=1, position="top"))
-                    video_img = np.concatenate(video_img, axis=1)  # Concatenate horizontally
-                    video_writer.append_data(video_img)
+                    video_img = [env.render(mode="rgb_array", height=512, width=512, camera_name=cam_name) for cam_name in camera_names]
+                    caption = (f"Gripper Action: {action_gripper_string}", 1, 1, "top")
+                    video_writer.append_data(video_img, [caption] * len(video_img))
                 
                 action_num += 1
                 gripper_action_num += 1
@@ -322,8 +341,89 @@ def playback_dataset(
         video_writer.close()
     
 
+class AsyncVideoWriter:
+    """
+    Video writer that annotates and encodes frames on a background thread, so that the
+    ffmpeg encoding overlaps with the simulation instead of blocking the next env step.
+    """
+
+    def __init__(self, video_name, fps=20, maxsize=64):
+        """
+        args:
+            video_name (str): path to save the video to
+            fps (int): frames per second of the video
+            maxsize (int): maximum number of frames waiting to be written
+        """
+        self.__writer = imageio.get_writer(video_name, fps=fps)
+        self.__queue = queue.Queue(maxsize=maxsize)
+        self.__error = None
+        # frame buffer reused across frames, only touched by the writer thread
+        self.__frame = None
+        self.__thread = threading.Thread(target=self._run, daemon=True)
+        self.__thread.start()
+
+    def append_data(self, images, captions, overlay=None):
+        """
+        Queue a frame made of the given camera images, concatenated horizontally.
+
+        args:
+            images (list): list of camera images
+            captions (list): (text, font_size, thickness, position) for each image, see put_text
+            overlay (tuple): optional (text, font_size, thickness, position) for the whole frame
+        """
+        self.__queue.put((images, captions, overlay))
+
+    def close(self):
+        """
+        Flush the queued frames and close the underlying writer.
+        """
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__writer.close()
+        if self.__error is not None:
+            raise self.__error
+
+    def _run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            # keep draining after a failure so that the simulation never blocks on a full queue
+            if self.__error is not None:
+                continue
+            try:
+                images, captions, overlay = item
+                frame = self._get_frame(images)
+                # copy each camera image into its slice of the frame and annotate it in place
+                col = 0
+                for img, caption in zip(images, captions):
+                    view = frame[:, col:col + img.shape[1]]
+                    np.copyto(view, img)
+                    put_text(view, *caption)
+                    col += img.shape[1]
+                if overlay is not None:
+                    put_text(frame, *overlay)
+                self.__writer.append_data(frame)
+            except Exception as e:
+                logger.error(f"Video writer failed: {e}")
+                self.__error = e
+
+    def _get_frame(self, images):
+        """
+        Return the frame buffer for the given camera images, reallocated only when the
+        frame size changes.
+        """
+        shape = (images[0].shape[0], sum(img.shape[1] for img in images), images[0].shape[2])
+        if self.__frame is None or self.__frame.shape != shape:
+            self.__frame = np.empty(shape, dtype=np.uint8)
+        return self.__frame
+
+
 def put_text(img, text, font_size=1, thickness=2, position="top"):
-    img = img.copy()
+    """
+    Draw text on the image in place. The image must be a writable uint8 array whose
+    pixels are contiguous (e.g. a column slice of a frame, not a flipped render).
+    """
     if position == "top":
         p = (10, 30)
     elif position == "bottom":